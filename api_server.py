@@ -1,23 +1,103 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, make_response
+from flask.json.provider import JSONProvider
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 import numpy as np
 import os
-import tempfile
-import uuid
+import secrets
 from io import BytesIO
 import base64
+import datetime
+import hashlib
+import math
+import threading
 import time
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Windows: sin bloqueo entre procesos
+    fcntl = None
+
+class OrjsonProvider(JSONProvider):
+    """Serializa las respuestas JSON con orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+    
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype='application/json')
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+# Con Apache/lighttpd (mod_xsendfile), send_file solo emite la cabecera X-Sendfile
+# y el servidor web envía el archivo desde disco
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '').lower() in ('1', 'true', 'yes')
 
 # Directorio para archivos temporales
 UPLOAD_FOLDER = 'output'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Limpieza periódica de la carpeta de salida
+CLEANUP_INTERVAL = 3600  # 1 hora
+CLEANUP_LOCK_NAME = '.cleanup.lock'
+CLEANUP_LOCK_PATH = os.path.join(UPLOAD_FOLDER, CLEANUP_LOCK_NAME)
+last_cleaned_count = 0
+
+# Prefijo interno de nginx para servir descargas con X-Accel-Redirect
+# (p. ej. "/internal_output/"); vacío = Flask envía el archivo
+X_ACCEL_REDIRECT_PREFIX = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '')
+
+# Tipos MIME de los archivos extraídos
+MIME_MAP = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'webp': 'image/webp',
+    'mp4': 'video/mp4',
+    'bin': 'application/octet-stream',
+}
+
+# Tamaño máximo aceptado para la imagen descargada
+MAX_DOWNLOAD_SIZE = 100 * 1024 * 1024  # 100MB
+
+# Sesión HTTP compartida (keep-alive y pool de conexiones entre peticiones)
+http_session = requests.Session()
+http_adapter = HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.1)
+)
+http_session.mount('https://', http_adapter)
+http_session.mount('http://', http_adapter)
+
+# Nivel de compresión zlib para las conversiones a PNG (0-9); los archivos
+# se sirven una vez y se eliminan a las 24h, así que prima la velocidad
+PNG_COMPRESS_LEVEL = int(os.environ.get('PNG_COMPRESS_LEVEL', '1'))
+
+# Caché LRU de conversiones a PNG, indexada por hash del contenido
+PNG_CACHE_SIZE = 64
+PNG_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memoria total que puede ocupar la caché
+PNG_CACHE_MAX_ENTRY_BYTES = 8 * 1024 * 1024  # PNGs mayores no se cachean
+png_cache = OrderedDict()
+png_cache_bytes = 0
+png_cache_lock = threading.Lock()
+
+# Caché LRU de decodificaciones: (sha256 de la imagen, force_png) -> archivo generado
+DECODED_CACHE_SIZE = 256
+decoded_cache = OrderedDict()
+decoded_cache_lock = threading.Lock()
+
 def download_image_from_url(url):
     """Descarga imagen desde URL o data URL"""
     try:
@@ -34,15 +114,27 @@ def download_image_from_url(url):
                 raise ValueError("Data URL inválida")
         else:
             # URL HTTP normal
-            response = requests.get(url, timeout=120)
-            response.raise_for_status()
-            
-            # Verificar que es una imagen
-            content_type = response.headers.get('content-type', '')
-            if not content_type.startswith('image/'):
-                raise ValueError(f"URL no contiene una imagen: {content_type}")
-            
-            return response.content
+            with http_session.get(url, timeout=(5, 120), stream=True) as response:
+                response.raise_for_status()
+                
+                # Verificar que es una imagen
+                content_type = response.headers.get('content-type', '')
+                if not content_type.startswith('image/'):
+                    raise ValueError(f"URL no contiene una imagen: {content_type}")
+                
+                content_length = int(response.headers.get('content-length') or 0)
+                if content_length > MAX_DOWNLOAD_SIZE:
+                    raise ValueError(f"Imagen demasiado grande: {content_length} bytes")
+                
+                # Acumular en BytesIO: getvalue() entrega los bytes sin copiarlos y
+                # BytesIO(bytes) en load_image_from_bytes también los comparte
+                buffer = BytesIO()
+                for chunk in response.iter_content(chunk_size=65536):
+                    buffer.write(chunk)
+                    if buffer.tell() > MAX_DOWNLOAD_SIZE:
+                        raise ValueError(f"Imagen demasiado grande: más de {MAX_DOWNLOAD_SIZE} bytes")
+                
+                return buffer.getvalue()
     except Exception as e:
         raise Exception(f"Error descargando imagen: {e}")
 
@@ -53,20 +145,18 @@ def load_image_from_bytes(image_bytes):
         if image.mode != 'RGB':
             image = image.convert('RGB')
         
-        img_array = np.array(image)
-        
-        if img_array.max() <= 1.0:
-            img_array = (img_array * 255).astype(np.uint8)
-        else:
-            img_array = img_array.astype(np.uint8)
-        
-        return img_array
+        # PIL en modo RGB siempre entrega uint8 en [0, 255]
+        return np.asarray(image, dtype=np.uint8)
     except Exception as e:
         raise Exception(f"Error procesando imagen: {e}")
 
 def extract_binary_from_lsb(image_array):
-    """Extrae datos binarios de los LSB con múltiples estrategias"""
+    """Extrae datos de los LSB con múltiples estrategias (incluye la cabecera de longitud)"""
     try:
+        # Garantizar memoria contigua para que reshape(-1) sea una vista sin copia
+        if not image_array.flags['C_CONTIGUOUS']:
+            image_array = np.ascontiguousarray(image_array)
+        
         height, width, channels = image_array.shape
         
         # Estrategias de extracción
@@ -76,88 +166,74 @@ def extract_binary_from_lsb(image_array):
             (0, 0)  # Toda la imagen
         ]
         
+        # Vista plana (fila/columna/canal): cada estrategia es un rango contiguo
+        flat = image_array.reshape(-1)
+        row_size = width * channels
+        
         for top_skip, bottom_skip in strategies:
-            start_row = top_skip
-            end_row = height - bottom_skip
-            binary_data = ""
+            start = top_skip * row_size
+            end = (height - bottom_skip) * row_size
+            if end - start < 32:
+                continue
+            
+            # Leer solo la cabecera de 32 bits (big-endian) con la longitud de los datos
+            header_bits = np.bitwise_and(flat[start:start + 32], 1)
+            data_length = int.from_bytes(np.packbits(header_bits).tobytes(), byteorder='big')
+            total_bits_needed = 32 + data_length * 8
             
-            for i in range(start_row, end_row):
-                for j in range(width):
-                    for k in range(channels):
-                        bit = image_array[i, j, k] & 1
-                        binary_data += str(bit)
-                        
-                        if len(binary_data) >= 32:
-                            try:
-                                length_binary = binary_data[:32]
-                                data_length = int(length_binary, 2)
-                                total_bits_needed = 32 + data_length * 8
-                                
-                                while len(binary_data) < total_bits_needed:
-                                    current_pos = len(binary_data)
-                                    pixel_index = current_pos // 3
-                                    channel_index = current_pos % 3
-                                    
-                                    available_pixels = (end_row - start_row) * width
-                                    if pixel_index >= available_pixels:
-                                        break
-                                    
-                                    row = start_row + (pixel_index // width)
-                                    col = pixel_index % width
-                                    
-                                    if row < end_row and col < width:
-                                        bit = image_array[row, col, channel_index] & 1
-                                        binary_data += str(bit)
-                                    else:
-                                        break
-                                
-                                if len(binary_data) >= total_bits_needed:
-                                    return binary_data[:total_bits_needed]
-                                    
-                            except ValueError:
-                                continue
+            # Extraer y empaquetar los LSB únicamente si los datos caben en la región
+            if total_bits_needed <= end - start:
+                return np.packbits(np.bitwise_and(flat[start:start + total_bits_needed], 1)).tobytes()
         
         return None
     except Exception as e:
         raise Exception(f"Error extrayendo datos: {e}")
 
-def binary_to_bytes(binary_string):
-    """Convierte binario a bytes"""
-    try:
-        if len(binary_string) % 8 != 0:
-            binary_string = binary_string[:-(len(binary_string) % 8)]
-        
-        byte_data = bytearray()
-        for i in range(0, len(binary_string), 8):
-            byte_str = binary_string[i:i+8]
-            byte_val = int(byte_str, 2)
-            byte_data.append(byte_val)
-        
-        return bytes(byte_data)
-    except Exception as e:
-        raise Exception(f"Error convirtiendo binario: {e}")
+def cache_png(content_hash, png_data):
+    """Guarda una conversión en la caché respetando el límite de entradas y de bytes"""
+    global png_cache_bytes
+    with png_cache_lock:
+        previous = png_cache.pop(content_hash, None)
+        if previous is not None:
+            png_cache_bytes -= len(previous)
+        png_cache[content_hash] = png_data
+        png_cache_bytes += len(png_data)
+        while len(png_cache) > PNG_CACHE_SIZE or png_cache_bytes > PNG_CACHE_MAX_BYTES:
+            _, evicted = png_cache.popitem(last=False)
+            png_cache_bytes -= len(evicted)
 
 def convert_to_png(image_data, original_format):
     """Convierte cualquier formato de imagen a PNG"""
     try:
-        from PIL import Image
-        import io
-        
         print(f"Convirtiendo {original_format.upper()} a PNG...")
         print(f"  Datos originales: {len(image_data)} bytes")
         print(f"  Magic bytes: {image_data[:8].hex()}")
         
+        # Reutilizar la conversión si ya se procesó el mismo contenido
+        content_hash = hashlib.blake2b(image_data, digest_size=16).digest()
+        with png_cache_lock:
+            png_data = png_cache.get(content_hash)
+            if png_data is not None:
+                png_cache.move_to_end(content_hash)
+        if png_data is not None:
+            print(f"  PNG en caché: {len(png_data)} bytes")
+            return png_data
+        
         # Abrir imagen desde bytes
-        img = Image.open(io.BytesIO(image_data))
+        img = Image.open(BytesIO(image_data))
         print(f"  Imagen abierta: {img.size}, modo: {img.mode}")
         
         # Convertir a PNG
-        png_buffer = io.BytesIO()
-        img.save(png_buffer, format='PNG')
+        png_buffer = BytesIO()
+        img.save(png_buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
         png_data = png_buffer.getvalue()
         
         print(f"  PNG generado: {len(png_data)} bytes")
         print(f"  PNG magic: {png_data[:8].hex()}")
+        
+        if len(png_data) <= PNG_CACHE_MAX_ENTRY_BYTES:
+            cache_png(content_hash, png_data)
+        
         print(f"CONVERSIÓN EXITOSA: {original_format.upper()} -> PNG")
         return png_data
         
@@ -166,119 +242,146 @@ def convert_to_png(image_data, original_format):
         print(f"  Devolviendo datos originales ({len(image_data)} bytes)")
         return image_data
 
-def detect_file_type(file_data):
-    """Detecta tipo de archivo y lo convierte a PNG si es necesario"""
+# Firmas de imágenes reconocidas al inicio de los datos, indexadas por sus
+# 2 primeros bytes: (firma o tupla de firmas, formato)
+DIRECT_MAGICS = {
+    b'\x89P': (b'\x89PNG', 'png'),
+    b'\xFF\xD8': (b'\xFF\xD8\xFF', 'jpg'),
+    b'GI': ((b'GIF87a', b'GIF89a'), 'gif'),
+    b'II': (b'II*\x00', 'tiff'),
+    b'MM': (b'MM\x00*', 'tiff'),
+    b'\x00\x00': (b'\x00\x00\x01\x00', 'ico'),
+}
+
+# Firmas de imágenes embebidas (se prueban en orden; gana la primera encontrada)
+EMBEDDED_SIGNATURES = {
+    'png': (b'\x89PNG',),
+    'jpg': (b'\xFF\xD8\xFF',),
+    'bmp': (b'BM',),
+    'gif': (b'GIF87a', b'GIF89a'),
+    'webp': (b'RIFF',),
+}
+
+# Formatos que se devuelven tal cual (visibles en cualquier cliente) salvo force_png
+NATIVE_FORMATS = ('jpg', 'webp')
+
+# Orden de preferencia entre imágenes embebidas
+EMBEDDED_PRIORITY = ('png', 'jpg', 'bmp', 'gif', 'webp')
+
+# Bytes iniciales donde se buscan primero las imágenes embebidas
+EMBEDDED_SEARCH_WINDOW = 64 * 1024
+# Límite de la búsqueda ampliada cuando la ventana inicial no basta
+EMBEDDED_SEARCH_MAX = 8 * 1024 * 1024
+
+def validate_bmp(bmp_data):
+    """Valida el header BMP y recorta los datos a su tamaño declarado"""
+    if len(bmp_data) < 6:
+        print("BMP con header incompleto")
+        return None
     
-    # === DETECCIÓN DE IMÁGENES DIRECTAS ===
+    bmp_size = int.from_bytes(bmp_data[2:6], byteorder='little')
+    print(f"Tamaño del BMP según header: {bmp_size} bytes")
     
-    # PNG directo
-    if file_data.startswith(b'\x89PNG'):
-        return "png", file_data
+    # Solo procesar si el tamaño es razonable
+    if 1000 <= bmp_size <= len(bmp_data) and bmp_size <= 50 * 1024 * 1024:  # Max 50MB
+        print(f"BMP válido, convirtiendo a PNG...")
+        return bmp_data[:bmp_size]
     
-    # JPEG → PNG
-    elif file_data.startswith(b'\xFF\xD8\xFF'):
-        png_data = convert_to_png(file_data, "jpg")
-        return "png", png_data
+    print(f"BMP con tamaño inválido: {bmp_size} bytes, saltando...")
+    return None
+
+def find_embedded_image(file_data, kind, limit):
+    """Devuelve la posición de la imagen embebida de tipo kind en file_data[:limit], o -1"""
+    for signature in EMBEDDED_SIGNATURES[kind]:
+        start = file_data.find(signature, 0, limit)
+        if start != -1:
+            break
+    # Un RIFF solo es WEBP si lleva la marca en su cabecera
+    if kind == 'webp' and start != -1 and b'WEBP' not in file_data[start:start+12]:
+        return -1
+    return start
+
+def detect_file_type(file_data, force_png=False):
+    """Detecta tipo de archivo y lo convierte a PNG si es necesario.
+    
+    Los datos devueltos son bytes-like: bytes, o una memoryview sobre file_data
+    cuando el archivo embebido se devuelve sin convertir.
+    """
     
-    # GIF → PNG
-    elif file_data.startswith(b'GIF87a') or file_data.startswith(b'GIF89a'):
-        png_data = convert_to_png(file_data, "gif")
+    # === DETECCIÓN DE IMÁGENES DIRECTAS ===
+    
+    entry = DIRECT_MAGICS.get(file_data[:2])
+    if entry and file_data.startswith(entry[0]):
+        kind = entry[1]
+        if kind == 'png' or (kind in NATIVE_FORMATS and not force_png):
+            return kind, file_data
+        png_data = convert_to_png(file_data, kind)
         return "png", png_data
     
-    # WEBP → PNG
-    elif file_data.startswith(b'RIFF') and b'WEBP' in file_data[:12]:
+    # WEBP (→ PNG solo con force_png)
+    if file_data.startswith(b'RIFF') and b'WEBP' in file_data[:12]:
+        if not force_png:
+            return "webp", file_data
         png_data = convert_to_png(file_data, "webp")
         return "png", png_data
     
     # BMP → PNG (con validación mejorada)
-    elif file_data.startswith(b'BM'):
+    if file_data.startswith(b'BM'):
         print(f"BMP detectado, validando header...")
-        if len(file_data) >= 6:
-            bmp_size = int.from_bytes(file_data[2:6], byteorder='little')
-            print(f"Tamaño del BMP según header: {bmp_size} bytes")
-            
-            # Solo procesar si el tamaño es razonable
-            if 1000 <= bmp_size <= len(file_data) and bmp_size <= 50 * 1024 * 1024:  # Max 50MB
-                bmp_data = file_data[:bmp_size]
-                print(f"BMP válido, convirtiendo a PNG...")
-                png_data = convert_to_png(bmp_data, "bmp")
-                return "png", png_data
-            else:
-                print(f"BMP con tamaño inválido: {bmp_size} bytes, saltando...")
-                return "bin", file_data
-        else:
-            print("BMP con header incompleto")
+        bmp_data = validate_bmp(file_data)
+        if bmp_data is None:
             return "bin", file_data
-    
-    # TIFF → PNG
-    elif file_data.startswith(b'II*\x00') or file_data.startswith(b'MM\x00*'):
-        png_data = convert_to_png(file_data, "tiff")
+        png_data = convert_to_png(bmp_data, "bmp")
         return "png", png_data
     
-    # ICO → PNG
-    elif file_data.startswith(b'\x00\x00\x01\x00'):
-        png_data = convert_to_png(file_data, "ico")
-        return "png", png_data
+    # Los datos embebidos se recortan como vistas para no copiar el resto del payload
+    payload_view = memoryview(file_data)
     
     # === DETECCIÓN DE VIDEOS EMBEBIDOS ===
     
-    # Buscar MP4 embebido
-    mp4_start = file_data.find(b'ftyp')
-    if mp4_start != -1 and mp4_start < 20:
+    # Buscar MP4 embebido: la caja 'ftyp' va justo tras su tamaño (4 bytes) y
+    # cerca del inicio, así que basta con buscar en los primeros bytes
+    mp4_start = file_data.find(b'ftyp', 4, 23)
+    if mp4_start != -1:
         print(f"MP4 embebido encontrado en posicion: {mp4_start}")
-        mp4_data = file_data[mp4_start-4:]  # Incluir los 4 bytes anteriores
+        mp4_data = payload_view[mp4_start-4:]  # Incluir los 4 bytes anteriores
         print(f"MP4 válido, tamaño: {len(mp4_data)} bytes")
         return "mp4", mp4_data
     
     # === DETECCIÓN DE IMÁGENES EMBEBIDAS ===
     
-    # Buscar PNG embebido
-    png_start = file_data.find(b'\x89PNG')
-    if png_start != -1:
-        png_data = file_data[png_start:]
-        return "png", png_data
+    # Las firmas reales aparecen casi siempre al inicio (tras la cabecera del
+    # codificador); si la ventana no basta se amplía hasta EMBEDDED_SEARCH_MAX
+    search_limits = [EMBEDDED_SEARCH_WINDOW]
+    if len(file_data) > EMBEDDED_SEARCH_WINDOW:
+        search_limits.append(min(len(file_data), EMBEDDED_SEARCH_MAX))
     
-    # Buscar JPEG embebido → PNG
-    jpg_start = file_data.find(b'\xFF\xD8\xFF')
-    if jpg_start != -1:
-        jpg_data = file_data[jpg_start:]
-        png_data = convert_to_png(jpg_data, "jpg")
-        return "png", png_data
-    
-    # Buscar BMP embebido → PNG (con validación)
-    bmp_start = file_data.find(b'BM')
-    if bmp_start != -1:
-        print(f"BMP embebido encontrado en posicion: {bmp_start}")
-        bmp_data = file_data[bmp_start:]
-        
-        if len(bmp_data) >= 6:
-            bmp_size = int.from_bytes(bmp_data[2:6], byteorder='little')
-            print(f"Tamaño del BMP según header: {bmp_size} bytes")
+    for limit in search_limits:
+        for kind in EMBEDDED_PRIORITY:
+            start = find_embedded_image(file_data, kind, limit)
+            if start == -1:
+                continue
+            
+            # PNG embebido
+            if kind == 'png':
+                return "png", payload_view[start:]
             
-            # Solo procesar si el tamaño es razonable
-            if 1000 <= bmp_size <= len(bmp_data) and bmp_size <= 50 * 1024 * 1024:  # Max 50MB
-                bmp_data = bmp_data[:bmp_size]
-                print(f"BMP válido, convirtiendo a PNG...")
+            # BMP embebido → PNG (con validación)
+            if kind == 'bmp':
+                print(f"BMP embebido encontrado en posicion: {start}")
+                bmp_data = validate_bmp(payload_view[start:])
+                if bmp_data is None:
+                    continue
                 png_data = convert_to_png(bmp_data, "bmp")
                 return "png", png_data
-            else:
-                print(f"BMP embebido con tamaño inválido: {bmp_size} bytes, saltando...")
-    
-    # Buscar GIF embebido → PNG
-    gif_start = file_data.find(b'GIF87a')
-    if gif_start == -1:
-        gif_start = file_data.find(b'GIF89a')
-    if gif_start != -1:
-        gif_data = file_data[gif_start:]
-        png_data = convert_to_png(gif_data, "gif")
-        return "png", png_data
-    
-    # Buscar WEBP embebido → PNG
-    webp_start = file_data.find(b'RIFF')
-    if webp_start != -1 and b'WEBP' in file_data[webp_start:webp_start+12]:
-        webp_data = file_data[webp_start:]
-        png_data = convert_to_png(webp_data, "webp")
-        return "png", png_data
+            
+            # JPEG / WEBP embebido (→ PNG solo con force_png)
+            if kind in NATIVE_FORMATS and not force_png:
+                return kind, payload_view[start:]
+            
+            # GIF embebido → PNG
+            png_data = convert_to_png(payload_view[start:], kind)
+            return "png", png_data
     
     # Fallback
     return "bin", file_data
@@ -290,18 +393,18 @@ def cleanup_old_files():
         cleaned_count = 0
         total_files = 0
         
-        for filename in os.listdir(UPLOAD_FOLDER):
-            file_path = os.path.join(UPLOAD_FOLDER, filename)
-            if os.path.isfile(file_path):
-                total_files += 1
-                file_age = current_time - os.path.getmtime(file_path)
-                if file_age > 86400:  # 1 día = 86400 segundos
-                    try:
-                        os.remove(file_path)
-                        cleaned_count += 1
-                        print(f"Archivo antiguo eliminado: {filename}")
-                    except Exception as e:
-                        print(f"Error eliminando {filename}: {e}")
+        with os.scandir(UPLOAD_FOLDER) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name != CLEANUP_LOCK_NAME:
+                    total_files += 1
+                    file_age = current_time - entry.stat().st_mtime
+                    if file_age > 86400:  # 1 día = 86400 segundos
+                        try:
+                            os.remove(entry.path)
+                            cleaned_count += 1
+                            print(f"Archivo antiguo eliminado: {entry.name}")
+                        except Exception as e:
+                            print(f"Error eliminando {entry.name}: {e}")
         
         if cleaned_count > 0:
             print(f"Limpieza completada: {cleaned_count} archivos eliminados de {total_files} total")
@@ -314,6 +417,90 @@ def cleanup_old_files():
         print(f"Error en limpieza: {e}")
         return 0
 
+def cleanup_loop():
+    """Ejecuta la limpieza periódicamente en segundo plano"""
+    global last_cleaned_count
+    while True:
+        try:
+            if fcntl is None:
+                last_cleaned_count = cleanup_old_files()
+            else:
+                # Cada worker de gunicorn tiene su propio hilo de limpieza; el lock
+                # de archivo hace que solo uno recorra la carpeta a la vez
+                with open(CLEANUP_LOCK_PATH, 'a') as lock_file:
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        pass  # Otro proceso está limpiando; omitir la pasada
+                    else:
+                        try:
+                            last_cleaned_count = cleanup_old_files()
+                        finally:
+                            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        except Exception as e:
+            # Un error puntual (p. ej. output/ sin permisos) no debe detener el hilo
+            print(f"Error en limpieza periódica: {e}")
+        time.sleep(CLEANUP_INTERVAL)
+
+# Limpieza en segundo plano, fuera del camino de las peticiones
+threading.Thread(target=cleanup_loop, daemon=True).start()
+
+def decode_file_from_bytes(image_bytes, force_png=False):
+    """Extrae el archivo oculto de la imagen; devuelve (tipo, datos bytes-like) o None"""
+    # Procesar imagen
+    print("Procesando imagen...")
+    img_array = load_image_from_bytes(image_bytes)
+    print(f"Imagen procesada: {img_array.shape}")
+    
+    # Extraer datos
+    print("Extrayendo datos ocultos...")
+    file_data = extract_binary_from_lsb(img_array)
+    
+    if file_data is None:
+        return None
+    
+    print(f"Bytes extraidos: {len(file_data)}")
+    
+    # Detectar tipo y convertir
+    file_type, extracted_data = detect_file_type(file_data, force_png)
+    print(f"Tipo detectado: {file_type}, tamaño: {len(extracted_data)} bytes")
+    
+    return file_type, extracted_data
+
+def decode_file_from_url(image_url, force_png=False):
+    """Descarga la imagen y extrae el archivo oculto; devuelve (tipo, datos) o None"""
+    print(f"Descargando imagen: {image_url}")
+    
+    # Descargar imagen
+    image_bytes = download_image_from_url(image_url)
+    print(f"Imagen descargada: {len(image_bytes)} bytes")
+    
+    return decode_file_from_bytes(image_bytes, force_png)
+
+def get_cached_decode(cache_key):
+    """Devuelve (tipo, nombre, tamaño, creación) de una decodificación previa si su archivo sigue existiendo"""
+    with decoded_cache_lock:
+        entry = decoded_cache.get(cache_key)
+        if entry is None:
+            return None
+        if not os.path.exists(os.path.join(UPLOAD_FOLDER, entry[1])):
+            # El archivo ya fue eliminado por la limpieza
+            del decoded_cache[cache_key]
+            return None
+        decoded_cache.move_to_end(cache_key)
+        return entry
+
+def store_cached_decode(cache_key, entry):
+    """Guarda el resultado de una decodificación en la caché LRU"""
+    with decoded_cache_lock:
+        decoded_cache[cache_key] = entry
+        if len(decoded_cache) > DECODED_CACHE_SIZE:
+            decoded_cache.popitem(last=False)
+
+def is_force_png_requested():
+    """Indica si la petición pide convertir JPEG/WEBP a PNG (?force_png=true)"""
+    return request.args.get('force_png', '').lower() in ('1', 'true', 'yes')
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -336,68 +523,69 @@ def decode_image():
             }), 400
         
         image_url = data['url']
+        force_png = is_force_png_requested()
         print(f"Descargando imagen: {image_url}")
         
         # Descargar imagen
         image_bytes = download_image_from_url(image_url)
         print(f"Imagen descargada: {len(image_bytes)} bytes")
         
-        # Procesar imagen
-        print("Procesando imagen...")
-        img_array = load_image_from_bytes(image_bytes)
-        print(f"Imagen procesada: {img_array.shape}")
-        
-        # Extraer datos
-        print("Extrayendo datos ocultos...")
-        binary_data = extract_binary_from_lsb(img_array)
-        
-        if not binary_data:
-            return jsonify({
-                "error": "No se encontraron datos ocultos en la imagen",
-                "success": False
-            }), 404
-        
-        print(f"Bits extraidos: {len(binary_data)}")
-        
-        # Convertir a bytes
-        file_data = binary_to_bytes(binary_data)
-        print(f"Bytes extraidos: {len(file_data)}")
-        
-        # Detectar tipo y convertir
-        file_type, extracted_data = detect_file_type(file_data)
-        print(f"Tipo detectado: {file_type}, tamaño: {len(extracted_data)} bytes")
-        
-        # Limpiar archivos antiguos
-        cleaned_files = cleanup_old_files()
+        # Reutilizar el archivo si esta misma imagen ya se decodificó
+        cache_key = (hashlib.sha256(image_bytes).digest(), force_png)
+        cached = get_cached_decode(cache_key)
         
-        # Crear archivo con nombre único
-        timestamp = int(time.time())
-        unique_id = str(uuid.uuid4())[:8]
-        temp_filename = f"decoded_{timestamp}_{unique_id}.{file_type}"
-        file_path = os.path.join(UPLOAD_FOLDER, temp_filename)
+        if cached is not None:
+            file_type, temp_filename, file_size, created_at = cached
+            print(f"Resultado en caché: {temp_filename}")
+        else:
+            decoded = decode_file_from_bytes(image_bytes, force_png)
+            
+            if decoded is None:
+                return jsonify({
+                    "error": "No se encontraron datos ocultos en la imagen",
+                    "success": False
+                }), 404
+            
+            file_type, extracted_data = decoded
+            file_size = len(extracted_data)
+            
+            # Crear archivo con nombre único
+            created_at = time.time()
+            timestamp = int(created_at)
+            unique_id = secrets.token_hex(4)
+            temp_filename = f"decoded_{timestamp}_{unique_id}.{file_type}"
+            file_path = os.path.join(UPLOAD_FOLDER, temp_filename)
+            
+            # Guardar archivo sin buffer de Python: una sola escritura directa al fd
+            with open(file_path, 'wb', buffering=0) as f:
+                written = f.write(extracted_data)
+            if written != file_size:
+                raise IOError(f"Escritura incompleta de {temp_filename}: {written} de {file_size} bytes")
+
+            store_cached_decode(cache_key, (file_type, temp_filename, file_size, created_at))
         
-        # Guardar archivo
-        with open(file_path, 'wb') as f:
-            f.write(extracted_data)
+        # Resultado de la última limpieza en segundo plano
+        cleaned_files = last_cleaned_count
         
         # Obtener la URL base del request
         base_url = request.url_root.rstrip('/')
         download_url = f"{base_url}/download/{temp_filename}"
         
-        # Calcular fecha de eliminación (1 día desde ahora)
-        import datetime
-        deletion_date = datetime.datetime.now() + datetime.timedelta(days=1)
+        # Calcular fecha de eliminación (1 día desde la creación del archivo)
+        deletion_date = datetime.datetime.fromtimestamp(created_at) + datetime.timedelta(days=1)
         deletion_timestamp = int(deletion_date.timestamp())
+        # En un resultado en caché el archivo ya lleva un tiempo en disco
+        expires_in_hours = max(0, math.ceil((created_at + 86400 - time.time()) / 3600))
         
         return jsonify({
             "success": True,
             "file_type": file_type,
-            "file_size": len(extracted_data),
+            "file_size": file_size,
             "download_url": download_url,
             "filename": temp_filename,
             "deletion_date": deletion_date.strftime("%Y-%m-%d %H:%M:%S UTC"),
             "deletion_timestamp": deletion_timestamp,
-            "expires_in_hours": 24,
+            "expires_in_hours": expires_in_hours,
             "cleanup_info": {
                 "files_cleaned": cleaned_files,
                 "cleanup_message": f"Se eliminaron {cleaned_files} archivos antiguos"
@@ -412,6 +600,44 @@ def decode_image():
             "success": False
         }), 500
 
+@app.route('/decode/direct', methods=['POST'])
+def decode_image_direct():
+    """Decodifica imagen desde URL y devuelve el archivo directamente"""
+    try:
+        data = request.get_json()
+        
+        if not data or 'url' not in data:
+            return jsonify({
+                "error": "URL requerida",
+                "example": {"url": "https://example.com/image.png"}
+            }), 400
+        
+        decoded = decode_file_from_url(data['url'], is_force_png_requested())
+        
+        if decoded is None:
+            return jsonify({
+                "error": "No se encontraron datos ocultos en la imagen",
+                "success": False
+            }), 404
+        
+        file_type, extracted_data = decoded
+        
+        # Enviar desde memoria, sin pasar por disco; BytesIO copiaría una memoryview,
+        # así que se convierte una sola vez a bytes, que BytesIO comparte
+        return send_file(
+            BytesIO(bytes(extracted_data)),
+            as_attachment=True,
+            download_name=f"decoded.{file_type}",
+            mimetype=MIME_MAP.get(file_type, 'application/octet-stream')
+        )
+        
+    except Exception as e:
+        print(f"Error en decode/direct: {e}")
+        return jsonify({
+            "error": str(e),
+            "success": False
+        }), 500
+
 @app.route('/download/<filename>', methods=['GET'])
 def download_file(filename):
     """Descarga archivo decodificado"""
@@ -421,6 +647,15 @@ def download_file(filename):
         if not os.path.exists(file_path):
             return jsonify({"error": "Archivo no encontrado"}), 404
         
+        # Delegar el envío al proxy inverso (sendfile del kernel) si está configurado
+        if X_ACCEL_REDIRECT_PREFIX:
+            file_type = filename.rsplit('.', 1)[-1]
+            response = make_response('')
+            response.headers['Content-Type'] = MIME_MAP.get(file_type, 'application/octet-stream')
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{filename}"
+            response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+            return response
+        
         return send_file(file_path, as_attachment=True)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -430,8 +665,10 @@ if __name__ == '__main__':
     print("Endpoints disponibles:")
     print("   GET  /health - Health check")
     print("   POST /decode - Decodificar imagen (devuelve JSON)")
+    print("   POST /decode/direct - Decodificar imagen (devuelve archivo)")
     print("   GET  /download/<filename> - Descargar archivo")
     print("\n Ejemplo de uso:")
     print('curl -X POST http://localhost:5000/decode -H "Content-Type: application/json" -d \'{"url": "https://example.com/image.png"}\'')
     
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Servidor de desarrollo; en producción usar gunicorn (ver Procfile/Dockerfile)
+    app.run(host='0.0.0.0', port=5000)
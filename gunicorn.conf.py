@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+# Configuración de gunicorn para TT-Tools API
+
+import multiprocessing
+import os
+
+# Dirección de escucha (Render/Heroku definen PORT)
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Pocos procesos, cada uno con un pool de hilos para solapar descargas y conversiones.
+# Cada worker carga numpy/PIL y sus cachés, y en contenedores cpu_count() devuelve
+# los núcleos del host: por defecto como mucho 2 (ajustable con WEB_CONCURRENCY)
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count(), 2)))
+threads = 4
+
+# Las descargas admiten hasta 120s de lectura; dejar margen para la decodificación
+timeout = 180